@@ -0,0 +1,104 @@
+import os
+import pickle
+import tempfile
+import yaml
+
+# Use the libyaml C loader/dumper when PyYAML was built with it
+_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# In-process cache of parsed configs keyed on (mtime, size)
+_cache = {}
+
+
+def _sidecar_path(path):
+    """
+    Path of the pickled sidecar cache for a config file
+    :param path: path to the config file
+    :return: path to the sidecar file
+    """
+
+    return path + '.cache.pkl'
+
+
+def _write_sidecar(path, key, parsed):
+    """
+    Atomically write the pickled sidecar so other processes skip the YAML parse
+    :param path: path to the config file
+    :param key: (mtime_ns, size) of the config file
+    :param parsed: dict with config values
+    :return:
+    """
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            pickle.dump((key, parsed), outfile)
+        os.replace(tmp_path, _sidecar_path(path))
+    except OSError:
+        os.unlink(tmp_path)
+
+
+def _read_sidecar(path, key):
+    """
+    Load the pickled sidecar if it matches the current config file
+    :param path: path to the config file
+    :param key: (mtime_ns, size) of the config file
+    :return: dict with config values, or None on miss
+    """
+
+    try:
+        with open(_sidecar_path(path), 'rb') as infile:
+            cached_key, parsed = pickle.load(infile)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+
+    if cached_key != key:
+        return None
+
+    return parsed
+
+
+def load_cfg(path="../../config.yml"):
+    """
+    Parse a YAML config file, reusing the parsed dict while the file is unchanged
+    :param path: path to the config file
+    :return: dict with config values
+    """
+
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    # Try the pickled sidecar before paying for the YAML parse
+    parsed = _read_sidecar(path, key)
+
+    if parsed is None:
+        with open(path, 'r') as infile:
+            parsed = yaml.load(infile, Loader=_LOADER)
+        _write_sidecar(path, key, parsed)
+
+    _cache[path] = (key, parsed)
+
+    return parsed
+
+
+def save_cfg(cfg, path="../../config.yml"):
+    """
+    Write the config dict back to disk and refresh the cache
+    :param cfg: dict with config values
+    :param path: path to the config file
+    :return:
+    """
+
+    with open(path, 'w') as outfile:
+        yaml.dump(cfg, outfile, Dumper=_DUMPER, default_flow_style=False)
+
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    _write_sidecar(path, key, cfg)
+    _cache[path] = (key, cfg)
@@ -0,0 +1,42 @@
+import sys
+sys.path.append('..')
+
+import db
+
+import create_model_holt_table
+import create_model_meta_table
+import create_model_simp_avg_table
+import create_qb_customers_table
+import create_quickbooks_tables
+import create_shopify_tables
+import create_square_tables
+import load_ref_tables
+
+# Every DDL block in the repo, run through the schema version check
+DDL_MODULES = [
+    create_square_tables,
+    create_shopify_tables,
+    create_quickbooks_tables,
+    create_qb_customers_table,
+    create_model_meta_table,
+    create_model_holt_table,
+    create_model_simp_avg_table,
+    load_ref_tables,
+]
+
+
+def main():
+    """
+    Run every CREATE TABLE script in one connection,
+    skipping the DDL blocks that have not changed
+    :return:
+    """
+
+    conn = db.get_connection()
+    for module in DDL_MODULES:
+        db.ensure_schema(conn, module.NAME, module.DDL)
+
+
+# Main section
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,13 @@
-import psycopg2
-import yaml
-
-# Load config file
-with open("../../config.yml", 'r') as infile:
-    cfg = yaml.load(infile)
-
-# Connect to database
-conn = psycopg2.connect("host={} dbname={} user={} password={}".format(cfg['db_IP'],
-                                                                       cfg['db_name'],
-                                                                       cfg['db_user_name'],
-                                                                       cfg['db_password']))
-
-# Create table
-cur = conn.cursor()
-cur.execute("""
+import sys
+sys.path.append('..')
+
+import db
+
+# Name this DDL block is tracked under in schema_versions
+NAME = 'model_holt'
+
+# DDL for the holt model output table
+DDL = """
 DROP TABLE IF EXISTS model_holt;
 
 CREATE TABLE model_holt(
@@ -23,5 +17,19 @@ CREATE TABLE model_holt(
     prediction float,
     forecast_start timestamp
 );
-""")
-conn.commit()
\ No newline at end of file
+"""
+
+
+def main():
+    """
+    Create the model_holt table
+    :return:
+    """
+
+    conn = db.get_connection()
+    db.ensure_schema(conn, NAME, DDL)
+
+
+# Main section
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import sys
+sys.path.append('..')
+
+import db
+
+# Name this DDL block is tracked under in schema_versions
+NAME = 'qb_customers'
+
+# DDL for the quickbooks customers table
+DDL = """
+DROP TABLE IF EXISTS qb_customers;
+
+CREATE TABLE qb_customers(
+    customer_id text,
+    customer_name text,
+    phone_number text,
+    address text,
+    city text,
+    state text,
+    zipcode text,
+    create_date timestamp
+);
+"""
+
+
+def main():
+    """
+    Create the qb_customers table
+    :return:
+    """
+
+    conn = db.get_connection()
+    db.ensure_schema(conn, NAME, DDL)
+
+
+# Main section
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,13 @@
-import psycopg2
-import yaml
-
-# Load config file
-with open("../../config.yml", 'r') as infile:
-    cfg = yaml.load(infile)
-
-# Connect to database
-conn = psycopg2.connect("host={} dbname={} user={} password={}".format(cfg['db_IP'],
-                                                                       cfg['db_name'],
-                                                                       cfg['db_user_name'],
-                                                                       cfg['db_password']))
-
-# Create table
-cur = conn.cursor()
-cur.execute("""
+import sys
+sys.path.append('..')
+
+import db
+
+# Name this DDL block is tracked under in schema_versions
+NAME = 'quickbooks'
+
+# DDL for the quickbooks transaction tables
+DDL = """
 DROP TABLE IF EXISTS qb_trans;
 
 CREATE TABLE qb_trans(
@@ -32,5 +26,19 @@ CREATE TABLE qb_trans_details(
     price float,
     dollars float
 );
-""")
-conn.commit()
+"""
+
+
+def main():
+    """
+    Create the quickbooks transaction tables
+    :return:
+    """
+
+    conn = db.get_connection()
+    db.ensure_schema(conn, NAME, DDL)
+
+
+# Main section
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,13 @@
-import psycopg2
-import yaml
-
-# Load config file
-with open("../../config.yml", 'r') as infile:
-    cfg = yaml.load(infile)
-
-# Connect to database
-conn = psycopg2.connect("host={} dbname={} user={} password={}".format(cfg['db_IP'],
-                                                                       cfg['db_name'],
-                                                                       cfg['db_user_name'],
-                                                                       cfg['db_password']))
-
-# Create table
-cur = conn.cursor()
-cur.execute("""
+import sys
+sys.path.append('..')
+
+import db
+
+# Name this DDL block is tracked under in schema_versions
+NAME = 'square'
+
+# DDL for the square transaction tables
+DDL = """
 DROP TABLE IF EXISTS square_trans;
 
 CREATE TABLE square_trans(
@@ -35,5 +29,19 @@ CREATE TABLE square_trans_details(
     modifiers text,
     variation_name text
 );
-""")
-conn.commit()
+"""
+
+
+def main():
+    """
+    Create the square transaction tables
+    :return:
+    """
+
+    conn = db.get_connection()
+    db.ensure_schema(conn, NAME, DDL)
+
+
+# Main section
+if __name__ == '__main__':
+    main()
@@ -1,69 +1,117 @@
-import psycopg2
-import yaml
+import sys
+sys.path.append('..')
+
+import hashlib
 import pandas as pd
-from sqlalchemy import create_engine
-
-# Load config file
-with open("../../config.yml", 'r') as infile:
-    cfg = yaml.load(infile)
-
-# Connect to database
-conn = psycopg2.connect("host={} dbname={} user={} password={}".format(cfg['db_IP'],
-                                                                       cfg['db_name'],
-                                                                       cfg['db_user_name'],
-                                                                       cfg['db_password']))
-
-# Create table
-cur = conn.cursor()
-cur.execute("""
-
-    DROP TABLE IF EXISTS items;
-    
-    CREATE TABLE items(
-        product_name text,
-        variant_name text,
-        zolo_id int,
-        square_id text,
-        quickbooks_id text,
-        shopify_id text,
-        category_name text,
-        form text,
-        weight float,
-        profile_id int
-        );
-        
-    DROP TABLE IF EXISTS coffee_profiles;
-    
-    CREATE TABLE coffee_profiles(
-        profile_id int,
-        profile_name text,
-        roast_level text,
-        active int,
-        single_origin int,
-        c1_origin text,
-        c1_process text,
-        c1_percent float,
-        c2_origin text,
-        c2_process text,
-        c2_percent float,
-        c3_procss text,
-        c3_origin text,
-        c3_percent float
+
+import db
+
+# Name this DDL block is tracked under in schema_versions
+NAME = 'ref_tables'
+
+# DDL for the reference tables
+DDL = """
+DROP TABLE IF EXISTS items;
+
+CREATE TABLE items(
+    product_name text,
+    variant_name text,
+    zolo_id int,
+    square_id text,
+    quickbooks_id text,
+    shopify_id text,
+    category_name text,
+    form text,
+    weight float,
+    profile_id int
+    );
+
+DROP TABLE IF EXISTS coffee_profiles;
+
+CREATE TABLE coffee_profiles(
+    profile_id int,
+    profile_name text,
+    roast_level text,
+    active int,
+    single_origin int,
+    c1_origin text,
+    c1_process text,
+    c1_percent float,
+    c2_origin text,
+    c2_process text,
+    c2_percent float,
+    c3_procss text,
+    c3_origin text,
+    c3_percent float
+    );
+
+DROP TABLE IF EXISTS ref_table_meta;
+
+CREATE TABLE ref_table_meta(
+    name text primary key,
+    hash text
+    );
+"""
+
+# Source CSV for each reference table
+REF_CSVS = {
+    'items': '../../data/ref_tables - items.csv',
+    'coffee_profiles': '../../data/ref_tables - coffee_profiles.csv',
+}
+
+
+def csv_hash(path):
+    """
+    Content hash of a ref CSV, used to detect unchanged files
+    :param path: path to the CSV
+    :return: hex digest string
+    """
+
+    with open(path, 'rb') as infile:
+        return hashlib.blake2b(infile.read()).hexdigest()
+
+
+def main():
+    """
+    Create the reference tables and load them from the ref CSVs,
+    skipping the reload when the CSVs are unchanged
+    :return:
+    """
+
+    conn = db.get_connection()
+    cur = conn.cursor()
+
+    # Make sure the hash bookkeeping table exists on first run
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ref_table_meta(
+        name text primary key,
+        hash text
         );
-    
-""")
-conn.commit()
-
-# Load data
-items = pd.read_csv('../../data/ref_tables - items.csv')
-coffee_profiles = pd.read_csv('../../data/ref_tables - coffee_profiles.csv')
-
-# Create connection engine
-engine = create_engine('postgresql://{}:{}@{}/{}'.format(cfg['db_user_name'],
-                                                         cfg['db_password'],
-                                                         cfg['db_IP'],
-                                                         cfg['db_name']))
-
-# Load to database
-items.to_sql('items', con=engine, if_exists='replace', index=False)
-coffee_profiles.to_sql('coffee_profiles', con=engine, if_exists='replace', index=False)
+    """)
+    conn.commit()
+
+    # Compare the CSV hashes against the last load
+    hashes = {name: csv_hash(path) for name, path in REF_CSVS.items()}
+
+    cur.execute('SELECT name, hash FROM ref_table_meta')
+    stored = dict(cur.fetchall())
+
+    if all(stored.get(name) == file_hash for name, file_hash in hashes.items()):
+        return
+
+    # Rebuild the tables and load the data
+    cur.execute(DDL)
+    conn.commit()
+
+    for name, path in REF_CSVS.items():
+        db.copy_df(conn, pd.read_csv(path), name)
+        cur.execute("""
+        INSERT INTO ref_table_meta (name, hash) VALUES (%s, %s)
+        ON CONFLICT (name) DO UPDATE SET hash = excluded.hash
+        """, (name, hashes[name]))
+    conn.commit()
+
+
+# Main section
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import io
+import hashlib
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+import db_pool
+from cfg import load_cfg
+
+# Arrow serializes the COPY payload in C when available
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+# Load config file
+cfg = load_cfg()
+
+# Cached connection and engine shared by the scripts in this repo
+_conn = None
+_engine = None
+
+
+def get_connection():
+    """
+    Return a psycopg2 connection to the warehouse, creating it on first use
+    :return: psycopg2 connection
+    """
+
+    global _conn
+
+    if _conn is None or _conn.closed:
+        _conn = db_pool.get_pool().getconn()
+
+    return _conn
+
+
+def get_engine():
+    """
+    Return the shared SQLAlchemy engine, creating it on first use
+    :return: SQLAlchemy engine
+    """
+
+    global _engine
+
+    if _engine is None:
+        _engine = create_engine('postgresql://{}:{}@{}/{}'.format(cfg['db_user_name'],
+                                                                  cfg['db_password'],
+                                                                  cfg['db_IP'],
+                                                                  cfg['db_name']),
+                                pool_size=5,
+                                max_overflow=10,
+                                pool_pre_ping=True,
+                                pool_recycle=1800,
+                                use_batch_mode=True)
+
+    return _engine
+
+
+def read_query(query, params=None, parse_dates=None):
+    """
+    Read a query result into a dataframe through COPY TO STDOUT,
+    skipping the per-row tuple objects read_sql_query goes through
+    :param query: SQL text of the query
+    :param params: optional dict of bind parameters
+    :param parse_dates: optional list of columns to parse as dates
+    :return: dataframe with the result set
+    """
+
+    conn = get_connection()
+    cur = conn.cursor()
+
+    # Bind parameters client-side since COPY takes no parameters
+    if params:
+        query = cur.mogrify(query, params).decode()
+
+    buf = io.StringIO()
+    cur.copy_expert('COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)'.format(query), buf)
+    buf.seek(0)
+
+    return pd.read_csv(buf, parse_dates=parse_dates)
+
+
+def ensure_schema(conn, name, ddl):
+    """
+    Run a DDL block only when it changed since the last run,
+    so reruns of the create scripts no longer wipe live tables
+    :param conn: psycopg2 connection
+    :param name: name the DDL block is tracked under in schema_versions
+    :param ddl: the DDL statement batch
+    :return: True when the DDL was executed, False when it was skipped
+    """
+
+    ddl_hash = hashlib.sha1(ddl.encode()).hexdigest()
+
+    cur = conn.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS schema_versions(
+        name text primary key,
+        hash text
+        );
+    """)
+
+    cur.execute('SELECT hash FROM schema_versions WHERE name = %s', (name,))
+    row = cur.fetchone()
+
+    if row and row[0] == ddl_hash:
+        conn.commit()
+        return False
+
+    cur.execute(ddl)
+    cur.execute("""
+    INSERT INTO schema_versions (name, hash) VALUES (%s, %s)
+    ON CONFLICT (name) DO UPDATE SET hash = excluded.hash
+    """, (name, ddl_hash))
+    conn.commit()
+
+    return True
+
+
+def copy_df(conn, df, table):
+    """
+    Bulk load a dataframe into a table with COPY FROM STDIN
+    :param conn: psycopg2 connection
+    :param df: dataframe whose columns match the destination table
+    :param table: name of the destination table
+    :return:
+    """
+
+    if pa is not None:
+        sink = pa.BufferOutputStream()
+        pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False),
+                         sink,
+                         pa_csv.WriteOptions(include_header=False))
+        buf = io.BytesIO(sink.getvalue().to_pybytes())
+    else:
+        buf = io.StringIO()
+        df.to_csv(buf, index=False, header=False)
+        buf.seek(0)
+
+    cur = conn.cursor()
+    cur.copy_expert('COPY {} ({}) FROM STDIN WITH CSV'.format(table, ', '.join(df.columns)), buf)
+    conn.commit()
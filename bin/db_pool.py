@@ -0,0 +1,43 @@
+from contextlib import contextmanager
+from psycopg2.pool import SimpleConnectionPool
+
+from cfg import load_cfg
+
+# Load config file
+cfg = load_cfg()
+
+# Pool shared by every ETL phase in the process
+_pool = None
+
+
+def get_pool():
+    """
+    Return the shared connection pool, building it on first use
+    :return: psycopg2 SimpleConnectionPool
+    """
+
+    global _pool
+
+    if _pool is None:
+        _pool = SimpleConnectionPool(1, 8, "host={} dbname={} user={} password={}".format(cfg['db_IP'],
+                                                                                          cfg['db_name'],
+                                                                                          cfg['db_user_name'],
+                                                                                          cfg['db_password']))
+
+    return _pool
+
+
+@contextmanager
+def connection():
+    """
+    Check a connection out of the pool and return it when done
+    :return: psycopg2 connection
+    """
+
+    pool = get_pool()
+    conn = pool.getconn()
+
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
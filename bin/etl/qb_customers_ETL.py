@@ -1,10 +1,18 @@
-import yaml
+import sys
+sys.path.append('..')
+
+import io
+import csv
+import math
+import time
 import logging
 import warnings
-import pandas as pd
-from sqlalchemy import create_engine
 import datetime as dt
-import psycopg2
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+import db_pool
+from cfg import load_cfg, save_cfg
 
 from quickbooks import QuickBooks
 from quickbooks import Oauth2SessionManager
@@ -14,8 +22,7 @@ from quickbooks import Oauth2SessionManager
 warnings.filterwarnings("ignore")
 
 # Load config file
-with open("../../config.yml", 'r') as infile:
-    cfg = yaml.load(infile)
+cfg = load_cfg()
 
 # Create logger
 logger = logging.getLogger(__name__)
@@ -24,16 +31,25 @@ logger.setLevel(logging.INFO)
 # Get datetime
 today = dt.datetime.utcnow().isoformat()
 
-# Create a file handler
-handler = logging.FileHandler('../../logs/qb_customers/{}.log'.format(today))
-handler.setLevel(logging.INFO)
+# Records per page for the QuickBooks API (max 1000)
+PAGE_SIZE = 1000
+
+# Customer rows per COPY batch
+COPY_BATCH_ROWS = 10000
 
-# create a logging format
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
 
-# add the handlers to the logger
-logger.addHandler(handler)
+def _setup_logging():
+    """
+    Attach this run's log file to the logger, done at run time
+    so importing the module does not open a file
+    :return:
+    """
+
+    handler = logging.FileHandler('../../logs/qb_customers/{}.log'.format(today))
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
 
 
 def main():
@@ -42,17 +58,18 @@ def main():
     :return:
     """
 
+    _setup_logging()
+
     logger.info('date_run for this ETL (UTC): {}'.format(today))
 
     # Run ETL
     customers = extract()
-    customer_table = transform(customers)
-    load(customer_table)
+    rows = transform(customers)
+    load(rows)
 
     # Update config file with last_update
     cfg['last_update_qb_customers'] = today
-    with open('../../config.yml', 'w') as outfile:
-        yaml.dump(cfg, outfile, default_flow_style=False)
+    save_cfg(cfg)
 
 
 def extract():
@@ -91,105 +108,98 @@ def extract():
                             """)
     num_customers = response['QueryResponse']['totalCount']
 
-    customers = []
-
-    for page in range(round(num_customers / 25)):
-        response = client.query("""
-                        select * from Customers 
-                        STARTPOSITION {} MAXRESULTS {}
-                        """.format((page * 25 + 1), 25))
-        customers.append(response)
-
-    logger.info('Data Extraction completed successfully')
-
-    return customers
+    def fetch_page(start_position):
+        """
+        Fetch one page of customers, retrying with backoff on HTTP errors
+        :param start_position: 1-based STARTPOSITION for the page
+        :return: JSON response for the page
+        """
+
+        last_error = None
+        for attempt in range(3):
+            try:
+                return client.query("""
+                                select * from Customers
+                                STARTPOSITION {} MAXRESULTS {}
+                                """.format(start_position, PAGE_SIZE))
+            except Exception as e:
+                last_error = e
+                logger.debug('Page at position {} failed (attempt {}): {}'.format(start_position, attempt + 1, e))
+                time.sleep(2 ** attempt)
+        raise last_error
+
+    # Stream the pages, keeping at most one batch of fetches in flight
+    positions = [page * PAGE_SIZE + 1 for page in range(math.ceil(num_customers / PAGE_SIZE))]
+
+    def iter_pages():
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for i in range(0, len(positions), 8):
+                for response in executor.map(fetch_page, positions[i:i + 8]):
+                    yield response
+        logger.info('Data Extraction completed successfully')
+
+    return iter_pages()
 
 
 def transform(customers):
     """
-    Takes the raw JSON responses and formats them into tables for the database
-    :param customers: list of JSON responses with customer information
-    :return: dataframes that will be the orders and order_details tables
+    Stream customer rows out of the raw JSON responses
+    :param customers: iterable of JSON responses with customer information
+    :return: generator of customer tuples for the qb_customers table
     """
 
     logger.info('Begin data transformation')
 
-    customers_dfs = []
-
     for batch in customers:
 
         for response in batch['QueryResponse']['Invoice']:
 
-            # Select all relevant data points
-            customer_id = response['Id']
-            customer_name = response['CompanyName']
-            phone_number = response['PrimaryPhone']['FreeFormNumber']
-            address = response['ShipAddr']['Line1']
-            city = response['ShipAddr']['City']
-            state = response['ShipAddr']['CountrySubDivisionCode']
-            zipcode = response['ShipAddr']['PostalCode']
-            create_date = response['MetaData']['CreateTime']
-
-            temp_df = pd.DataFrame({'customer_id': customer_id,
-                                    'customer_name': customer_name,
-                                    'phone_number': phone_number,
-                                    'address': address,
-                                    'city': city,
-                                    'state': state,
-                                    'zipcode': zipcode,
-                                    'create_date': create_date})
-            customers_dfs.append(temp_df)
-
-    customers_table = pd.concat(customers_dfs)
+            # Walk each nested dict once and tolerate missing fields
+            ship = response.get('ShipAddr') or {}
 
-    logger.info('Data transformation completed successfully')
+            yield (response.get('Id'),
+                   response.get('CompanyName'),
+                   (response.get('PrimaryPhone') or {}).get('FreeFormNumber'),
+                   ship.get('Line1'),
+                   ship.get('City'),
+                   ship.get('CountrySubDivisionCode'),
+                   ship.get('PostalCode'),
+                   (response.get('MetaData') or {}).get('CreateTime'))
 
-    return customers_table
 
-
-def load(customers_table):
+def load(rows):
     """
-    Load tables to the database
-    :param customers_table: tuple of dataframes
+    Stream the customer rows into the database
+    :param rows: iterable of customer tuples
     :return:
     """
 
     logger.info('Begin data load')
 
-    # Connect to database
-    conn = psycopg2.connect("host={} dbname={} user={} password={}".format(cfg['db_IP'],
-                                                                           cfg['db_name'],
-                                                                           cfg['db_user_name'],
-                                                                           cfg['db_password']))
-
-    # Create table
-    cur = conn.cursor()
-    cur.execute("""
-    DROP TABLE IF EXISTS qb_customers
-
-    CREATE TABLE qb_customers(
-        customer_id text,
-        customer_name text,
-        phone_number text,
-        address text,
-        city text,
-        state text,
-        zipcode text,
-        create_date timestamp,
-        
-    );
-    """)
-
-    # Create connection engine
-    engine = create_engine('postgresql://{}:{}@{}/{}'.format(cfg['db_user_name'],
-                                                             cfg['db_password'],
-                                                             cfg['db_IP'],
-                                                             cfg['db_name']))
-
-    # Load to database
-    customers_table.to_sql('qb_customers', con=engine, if_exists='replace', index=False)
-
-    logger.info('Loading {} records to qb_customers'.format(len(customers_table)))
+    with db_pool.connection() as conn:
+
+        # Full refresh: clear out the previous customer list and reload
+        # it in the same transaction
+        cur = conn.cursor()
+        cur.execute('TRUNCATE qb_customers')
+
+        # COPY the rows in fixed-size batches so memory stays constant
+        num_rows = 0
+
+        while True:
+            chunk = list(islice(rows, COPY_BATCH_ROWS))
+            if not chunk:
+                break
+
+            buf = io.StringIO()
+            csv.writer(buf).writerows(chunk)
+            buf.seek(0)
+            cur.copy_expert('COPY qb_customers FROM STDIN WITH CSV', buf)
+            num_rows += len(chunk)
+
+        conn.commit()
+
+    logger.info('Loading {} records to qb_customers'.format(num_rows))
     logger.info('Data load completed successfully')
 
 
@@ -1,10 +1,18 @@
-import yaml
+import sys
+sys.path.append('..')
+
+import io
+import csv
+import math
+import time
 import logging
 import warnings
-import pandas as pd
-from sqlalchemy import create_engine
 import datetime as dt
-import numpy as np
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+import db_pool
+from cfg import load_cfg, save_cfg
 
 from quickbooks import QuickBooks
 from quickbooks import Oauth2SessionManager
@@ -14,27 +22,35 @@ from quickbooks import Oauth2SessionManager
 warnings.filterwarnings("ignore")
 
 # Load config file
-with open("../../config.yml", 'r') as infile:
-    cfg = yaml.load(infile)
+cfg = load_cfg()
 
 # Get start and end dates
 end_date = dt.datetime.utcnow().isoformat()
 start_date = cfg['last_update_quickbooks']
 
+# Records per page for the QuickBooks API (max 1000)
+PAGE_SIZE = 1000
+
+# Line item rows per COPY batch
+COPY_BATCH_ROWS = 10000
+
 # Create logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# create a file handler
-handler = logging.FileHandler('../../logs/quickbooks/{}.log'.format(end_date))
-handler.setLevel(logging.INFO)
 
-# create a logging format
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
+def _setup_logging():
+    """
+    Attach this run's log file to the logger, done at run time
+    so importing the module does not open a file
+    :return:
+    """
 
-# add the handlers to the logger
-logger.addHandler(handler)
+    handler = logging.FileHandler('../../logs/quickbooks/{}.log'.format(end_date))
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
 
 
 def main():
@@ -43,17 +59,18 @@ def main():
     :return:
     """
 
+    _setup_logging()
+
     logger.info('date_range for this ETL (UTC): {} - {}'.format(start_date, end_date))
 
     # Run ETL
     orders = extract(start_date, end_date)
-    orders_dfs = transform(orders)
-    load(orders_dfs)
+    rows = transform(orders)
+    load(rows)
 
     # Update config file with last_update
     cfg['last_update_quickbooks'] = end_date
-    with open('../../config.yml', 'w') as outfile:
-        yaml.dump(cfg, outfile, default_flow_style=False)
+    save_cfg(cfg)
 
 
 def extract(start_date, end_date):
@@ -61,7 +78,7 @@ def extract(start_date, end_date):
     Connect to the shopify API and pull orders for the given time period
     :param start_date: timestamp indicating beginning of time range
     :param end_date: timestamp indicating end of time range
-    :return: list of JSON responses
+    :return: generator of JSON responses, one per page
     """
 
     logger.info('Begin Extract')
@@ -95,35 +112,52 @@ def extract(start_date, end_date):
                             """.format(start_date, end_date))
     num_invoices = response['QueryResponse']['totalCount']
 
-    orders = []
-
-    for page in range(round(num_invoices / 25)):
-        response = client.query("""
-                        select * from Invoice 
-                        where TxnDate > '{}' and TxnDate < '{}'
-                        STARTPOSITION {} MAXRESULTS {}
-                        """.format(start_date,
-                                   end_date,
-                                   (page * 25 + 1),
-                                   25))
-        orders.append(response)
-
-    logger.info('Data Extraction completed successfully')
-
-    return orders
+    def fetch_page(start_position):
+        """
+        Fetch one page of invoices, retrying with backoff on HTTP errors
+        :param start_position: 1-based STARTPOSITION for the page
+        :return: JSON response for the page
+        """
+
+        last_error = None
+        for attempt in range(3):
+            try:
+                return client.query("""
+                                select * from Invoice
+                                where TxnDate > '{}' and TxnDate < '{}'
+                                STARTPOSITION {} MAXRESULTS {}
+                                """.format(start_date,
+                                           end_date,
+                                           start_position,
+                                           PAGE_SIZE))
+            except Exception as e:
+                last_error = e
+                logger.debug('Page at position {} failed (attempt {}): {}'.format(start_position, attempt + 1, e))
+                time.sleep(2 ** attempt)
+        raise last_error
+
+    # Stream the pages, keeping at most one batch of fetches in flight
+    positions = [page * PAGE_SIZE + 1 for page in range(math.ceil(num_invoices / PAGE_SIZE))]
+
+    def iter_pages():
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for i in range(0, len(positions), 8):
+                for response in executor.map(fetch_page, positions[i:i + 8]):
+                    yield response
+        logger.info('Data Extraction completed successfully')
+
+    return iter_pages()
 
 
 def transform(orders):
     """
-    Takes the raw JSON responses and formats them into tables for the database
-    :param orders: list of JSON resonses with order information
-    :return: dataframes that will be the orders and order_details tables
+    Stream line item rows out of the raw JSON responses
+    :param orders: iterable of JSON responses with order information
+    :return: generator of line item tuples for the staging table
     """
 
     logger.info('Begin data transformation')
 
-    order_dfs = []
-
     for batch in orders:
 
         for response in batch['QueryResponse']['Invoice']:
@@ -136,107 +170,80 @@ def transform(orders):
             # Filter out irrelevant dicts from line details
             new_lines = [i for i in response['Line'] if 'Id' in i.keys()]
 
-            # Quickbooks id
-            quickbooks_id = []
             for line in new_lines:
-                try:
-                    quickbooks_id.append(line['SalesItemLineDetail']['ItemRef']['value'])
-                except KeyError:
-                    quickbooks_id.append(np.nan)
+                detail = line.get('SalesItemLineDetail') or {}
+                quantity = detail.get('Qty')
+                price = detail.get('UnitPrice')
+                dollars = quantity * price if quantity is not None and price is not None else None
 
-            # Quantity
-            quantity = []
-            for line in new_lines:
-                try:
-                    quantity.append(line['SalesItemLineDetail']['Qty'])
-                except KeyError:
-                    quantity.append(np.nan)
+                yield (payment_id,
+                       created_at,
+                       customer_id,
+                       (detail.get('ItemRef') or {}).get('value'),
+                       quantity,
+                       price,
+                       dollars)
 
-            # Price
-            price = []
-            for line in new_lines:
-                try:
-                    price.append(line['SalesItemLineDetail']['UnitPrice'])
-                except KeyError:
-                    price.append(np.nan)
-
-            temp_df = pd.DataFrame({'payment_id': payment_id,
-                                    'created_at': created_at,
-                                    'customer_id': customer_id,
-                                    'quickbooks_id': quickbooks_id,
-                                    'quantity': quantity,
-                                    'price': price})
-            order_dfs.append(temp_df)
-
-    try:
-        invoices = pd.concat(order_dfs)
-    except ValueError:
-        invoices = pd.DataFrame(columns=[
-            'payment_id',
-            'created_at',
-            'customer_id',
-            'quickbooks_id',
-            'quantity',
-            'price'
-        ])
-
-    # Calc total dollars for the invoice
-    invoices['dollars'] = invoices['quantity'] * invoices['price']
-
-    # Create aggregation instructions
-    agg_dict = {
-        'quantity':'sum',
-        'price':'sum',
-        'dollars':'sum'
-    }
-
-    # Agg lines items to get invoice summary
-    qb_trans = invoices.groupby(['payment_id', 'created_at', 'customer_id']).agg(agg_dict).reset_index()
-
-    qb_trans = qb_trans.loc[:, [
-
-        'payment_id',
-        'created_at',
-        'customer_id',
-        'dollars',
-    ]]
-
-    # Create the shopify transaction details table
-    qb_trans_details = invoices.loc[:, [
-
-        'payment_id',
-        'quickbooks_id',
-        'quantity',
-        'price',
-        'dollars'
-    ]]
-
-    logger.info('Data transformation completed successfully')
-
-    return qb_trans_details, qb_trans
-
-
-def load(orders_df):
+
+def load(rows):
     """
-    Load tables to the database
-    :param orders_df: tuple of dataframes
+    Stream the line items into the database and aggregate the invoice summary there
+    :param rows: iterable of line item tuples
     :return:
     """
 
     logger.info('Begin data load')
 
-    # Create connection engine
-    engine = create_engine('postgresql://{}:{}@{}/{}'.format(cfg['db_user_name'],
-                                                             cfg['db_password'],
-                                                             cfg['db_IP'],
-                                                             cfg['db_name']))
-
-    # Load to database
-    orders_df[0].to_sql('qb_trans_details', con=engine, if_exists='append', index=False)
-    orders_df[1].to_sql('qb_trans', con=engine, if_exists='append', index=False)
-
-    logger.info('Loading {} records to square_trans_details'.format(len(orders_df[0])))
-    logger.info('Loading {} records to square_trans'.format(len(orders_df[1])))
+    with db_pool.connection() as conn:
+
+        # Stage the line items so the summary only aggregates this run's
+        # rows; quantity stays float here since QuickBooks sends decimals
+        # like '1.0' that COPY will not cast into an int column, and the
+        # INSERT below assignment-casts it into qb_trans_details
+        cur = conn.cursor()
+        cur.execute("""
+        DROP TABLE IF EXISTS qb_trans_stage;
+
+        CREATE TEMP TABLE qb_trans_stage(
+            payment_id text,
+            created_at timestamp,
+            customer_id text,
+            quickbooks_id text,
+            quantity float,
+            price float,
+            dollars float
+        );
+        """)
+        conn.commit()
+
+        # COPY the rows in fixed-size batches so memory stays constant
+        num_rows = 0
+
+        while True:
+            chunk = list(islice(rows, COPY_BATCH_ROWS))
+            if not chunk:
+                break
+
+            buf = io.StringIO()
+            csv.writer(buf).writerows(chunk)
+            buf.seek(0)
+            cur.copy_expert('COPY qb_trans_stage FROM STDIN WITH CSV', buf)
+            num_rows += len(chunk)
+
+        # Move the line items over and let Postgres aggregate the summary
+        cur.execute("""
+        INSERT INTO qb_trans_details (payment_id, quickbooks_id, quantity, price, dollars)
+        SELECT payment_id, quickbooks_id, quantity, price, dollars
+        FROM qb_trans_stage;
+
+        INSERT INTO qb_trans (payment_id, created_at, customer_id, dollars)
+        SELECT payment_id, min(created_at), min(customer_id), sum(dollars)
+        FROM qb_trans_stage
+        GROUP BY payment_id;
+        """)
+        conn.commit()
+
+    logger.info('Loading {} records to qb_trans_details'.format(num_rows))
     logger.info('Data load completed successfully')
 
 
@@ -1,21 +1,28 @@
-import yaml
+import sys
+sys.path.append('..')
+
 import logging
 import warnings
+import itertools
 import pandas as pd
-from sqlalchemy import create_engine
+from pandas.io.json import json_normalize
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import datetime as dt
-import numpy as np
-import math
+from urllib.parse import urlencode
+
+import db
+import db_pool
+from cfg import load_cfg, save_cfg
 
 
 # Ignore warnings
 warnings.filterwarnings("ignore")
 
 # Load config file
-with open("../../config.yml", 'r') as infile:
-    cfg = yaml.load(infile)
+cfg = load_cfg()
 
 # Get start and end dates
 end_date = dt.datetime.utcnow().isoformat()
@@ -25,16 +32,19 @@ start_date = cfg['last_update_shopify']
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# create a file handler
-handler = logging.FileHandler('../../logs/shopify/{}.log'.format(end_date))
-handler.setLevel(logging.INFO)
 
-# create a logging format
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
+def _setup_logging():
+    """
+    Attach this run's log file to the logger, done at run time
+    so importing the module does not open a file
+    :return:
+    """
 
-# add the handlers to the logger
-logger.addHandler(handler)
+    handler = logging.FileHandler('../../logs/shopify/{}.log'.format(end_date))
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
 
 
 def main():
@@ -43,6 +53,8 @@ def main():
     :return:
     """
 
+    _setup_logging()
+
     logger.info('date_range for this ETL (UTC): {} - {}'.format(start_date, end_date))
 
     # Run ETL
@@ -52,8 +64,7 @@ def main():
 
     # Update config file with last_update
     cfg['last_update_shopify'] = end_date
-    with open('../../config.yml', 'w') as outfile:
-        yaml.dump(cfg, outfile, default_flow_style=False)
+    save_cfg(cfg)
 
 
 def extract(start_date, end_date):
@@ -70,21 +81,29 @@ def extract(start_date, end_date):
     shop_url = "https://{}:{}@{}.myshopify.com/admin".format(cfg['shopify_key'],
                                                              cfg['shopify_password'],
                                                              cfg['shopify_store_name'])
-    query_count = '/orders/count.json?created_at_min={}?created_at_max{}'.format(start_date, end_date)
-
-    # Make the request for counts
-    r = requests.get(shop_url + query_count)
-    orders_count = r.json()['count']
+    # One session with a bounded connection pool and retries on throttling
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+    session.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=retry))
 
+    # Page through with a since_id cursor at the 250-order page max,
+    # so the server never re-scans earlier pages
     orders = []
-
-    # Loop through the pages and store the responses
-    for page in range(math.ceil(orders_count / 50)):
-        query_orders = shop_url + '/orders.json?created_at_min={}?created_at_max={}?limit=50&page={}'.format(start_date,
-                                                                                                             end_date,
-                                                                                                             page + 1)
-        r = requests.get(query_orders)
-        orders.append(r.json())
+    last_id = 0
+
+    while True:
+        query_orders = '/orders.json?' + urlencode({
+            'created_at_min': start_date,
+            'created_at_max': end_date,
+            'limit': 250,
+            'since_id': last_id
+        })
+        batch = session.get(shop_url + query_orders).json()
+        orders.append(batch)
+
+        if len(batch['orders']) < 250:
+            break
+        last_id = batch['orders'][-1]['id']
 
     logger.info('Data Extraction completed successfully')
 
@@ -100,39 +119,24 @@ def transform(orders):
 
     logger.info('Begin data transformation')
 
-    # Unpack response
-    orders_dfs = []
-
-    for batch in orders:
-
-        for order in batch['orders']:
-
-            # Pull out relevant data points
-            order_id = order['id']
-            created_at = order['created_at']
-            quantity = [int(i['quantity']) for i in order['line_items']]
-            shopify_id = [i['variant_id'] for i in order['line_items']]
-            price = [float(i['price']) for i in order['line_items']]
-            try:
-                shipping_price = [float(i['price']) for i in order['shipping_lines']][0]
-            except IndexError:
-                shipping_price = np.nan
-
-            # Store in dataframe
-            temp_df = pd.DataFrame({
-                'order_id': order_id,
-                'created_at': created_at,
-                'quantity': quantity,
-                'shopify_id': shopify_id,
-                'price': price,
-                'shipping_price': shipping_price
-            })
-            orders_dfs.append(temp_df)
-
-    # Union all dataframes
-    try:
-        data = pd.concat(orders_dfs)
-    except ValueError:
+    # Flatten the batches and explode the line items in one pass
+    all_orders = list(itertools.chain.from_iterable(batch['orders'] for batch in orders))
+
+    if all_orders:
+        flat = json_normalize(all_orders,
+                              record_path='line_items',
+                              meta=['id', 'created_at', 'shipping_lines'],
+                              record_prefix='li_')
+
+        data = pd.DataFrame({
+            'order_id': flat['id'],
+            'created_at': flat['created_at'],
+            'quantity': flat['li_quantity'].astype(int),
+            'shopify_id': flat['li_variant_id'],
+            'price': flat['li_price'].astype(float),
+            'shipping_price': flat['shipping_lines'].str[0].str.get('price').astype(float)
+        })
+    else:
         data = pd.DataFrame(columns=[
 
             'order_id',
@@ -191,15 +195,10 @@ def load(orders_df):
 
     logger.info('Begin data load')
 
-    # Create connection engine
-    engine = create_engine('postgresql://{}:{}@{}/{}'.format(cfg['db_user_name'],
-                                                             cfg['db_password'],
-                                                             cfg['db_IP'],
-                                                             cfg['db_name']))
-
-    # Load to database
-    orders_df[0].to_sql('shopify_trans_details', con=engine, if_exists='append', index=False)
-    orders_df[1].to_sql('shopify_trans', con=engine, if_exists='append', index=False)
+    # COPY straight into the tables through a pooled connection
+    with db_pool.connection() as conn:
+        db.copy_df(conn, orders_df[0], 'shopify_trans_details')
+        db.copy_df(conn, orders_df[1], 'shopify_trans')
 
     logger.info('Loading {} records to square_trans_details'.format(len(orders_df[0])))
     logger.info('Loading {} records to square_trans'.format(len(orders_df[1])))
@@ -1,18 +1,22 @@
+import sys
+sys.path.append('..')
+
 import lib
-import yaml
 import logging
 import warnings
 import pandas as pd
 import datetime as dt
-from sqlalchemy import create_engine
+
+import db
+import db_pool
+from cfg import load_cfg, save_cfg
 
 
 # Ignore warnings
 warnings.filterwarnings("ignore")
 
 # Load config file
-with open("../../config.yml", 'r') as infile:
-    cfg = yaml.load(infile)
+cfg = load_cfg()
 
 # Store date information
 today = dt.datetime.today()
@@ -23,16 +27,19 @@ forecast_start = forecast_start.date()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Create a file handler
-handler = logging.FileHandler('../../logs/models/arima_{}.log'.format(forecast_start))
-handler.setLevel(logging.INFO)
 
-# Create a logging format
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
+def _setup_logging():
+    """
+    Attach this run's log file to the logger, done at run time
+    so importing the module does not open a file
+    :return:
+    """
 
-# Add the handlers to the logger
-logger.addHandler(handler)
+    handler = logging.FileHandler('../../logs/models/arima_{}.log'.format(forecast_start))
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
 
 
 def main():
@@ -41,6 +48,8 @@ def main():
     :return:
     """
 
+    _setup_logging()
+
     logger.info('start_date for this forecast: {}'.format(forecast_start))
 
     # Set model orders to search
@@ -56,8 +65,7 @@ def main():
 
     # Update config file with last_update
     cfg['last_model_run'] = forecast_start
-    with open('../../config.yml', 'w') as outfile:
-        yaml.dump(cfg, outfile, default_flow_style=False)
+    save_cfg(cfg)
 
 
 def extract():
@@ -68,10 +76,6 @@ def extract():
 
     logger.info('Begin Extract')
 
-    engine = create_engine('postgresql://{}:{}@{}/{}'.format(cfg['db_user_name'],
-                                                             cfg['db_password'],
-                                                             cfg['db_IP'],
-                                                             cfg['db_name']))
     query = """
 
     with square_weekly as (
@@ -120,26 +124,37 @@ def extract():
     created_at > '2017-10-1')
 
     select
+        profile_name,
+        week_date,
+        weight
+    from
+    (select
         u2.profile_name,
-        u2.week_date, 
-        sum(u2.total_weight) as weight
+        u2.week_date,
+        sum(u2.total_weight) as weight,
+        count(*) over (partition by u2.profile_name) as week_count
     from
-    (select * 
+    (select *
     from
     (select *
     from shopify_weekly
     union all
-    select * 
+    select *
     from square_weekly) as u1
-    union all 
-    select * 
+    union all
+    select *
     from quickbooks_weekly
     ) as u2
+    where u2.week_date < %(forecast_start)s
     group by u2.profile_name, u2.week_date
-    order by u2.profile_name, u2.week_date
+    ) as weekly
+    where week_count > 5
+    order by profile_name, week_date
 
-    """.format(str(forecast_start), str(forecast_start))
-    data = pd.read_sql_query(query, con=engine)
+    """
+    # COPY the result set out as CSV rather than row tuples
+    data = db.read_query(query, params={'forecast_start': forecast_start},
+                         parse_dates=['week_date'])
 
     logger.info('Data Extraction completed successfully')
 
@@ -154,15 +169,10 @@ def transform(data):
 
     logger.info('Begin data transformation')
 
-    # Get relevant temporally relevant data
-    data = data[data['week_date'] < forecast_start]
-
-    # Exclude profile/forms with low counts
-    data['week_count'] = data['week_date'].groupby(data['profile_name']).transform('count')
-    data = data[data['week_count'] > 5]
-
-    # Aggregate data
-    model_data = data.groupby(['week_date', 'profile_name']).sum().reset_index()
+    # The query already filters and aggregates per profile and week,
+    # so just pin down the dtype the models expect
+    data['weight'] = data['weight'].astype('float64')
+    model_data = data
 
     logger.info('Data transformation completed successfully')
 
@@ -181,37 +191,37 @@ def model(model_data, p_values, d_values, q_values):
 
     logger.info('Begin modelling')
 
-    # Create framework for final dataframe
-    meta_df = pd.DataFrame(columns=[
-        'profile_name',
-        'best_config',
-        'mse',
-        'prediction',
-        'std_error',
-    ])
+    # Collect one row per profile and build the final frame once
+    rows = []
 
-    # For each profile/form combo fit model
-    for zolo_id in model_data['profile_name'].sort_values().unique():
-
-        # Get data for profile/form
-        temp_data = model_data[model_data['profile_name'] == zolo_id]
+    # For each profile/form combo fit model, partitioning the frame once
+    for zolo_id, temp_data in model_data.groupby('profile_name', sort=True):
 
         # Grid search model params
         best_cfg, mse, best_model = lib.evaluate_models(temp_data['weight'].values, p_values, d_values, q_values)
 
         # Store meta information about models
         forecast = best_model.forecast()
-        temp_df = pd.DataFrame({
-            'profile_name': [zolo_id],
-            'best_config': [best_cfg],
-            'mse': [mse],
-            'prediction': forecast[0],
-            'std_error': forecast[1],
+        rows.append({
+            'profile_name': zolo_id,
+            # Stringify the order tuple so the column is plain text on
+            # both copy_df serialization paths
+            'best_config': str(best_cfg),
+            'mse': mse,
+            'prediction': forecast[0][0],
+            'std_error': forecast[1][0],
         })
-        meta_df = pd.concat((meta_df, temp_df))
 
         logger.info('name_form: {} model complete'.format(zolo_id))
 
+    meta_df = pd.DataFrame(rows, columns=[
+        'profile_name',
+        'best_config',
+        'mse',
+        'prediction',
+        'std_error',
+    ])
+
     # Calculate lower and upper bounds of CI
     meta_df['lower_bound'] = meta_df['prediction'] - (1.96 * meta_df['std_error'])
     meta_df['upper_bound'] = meta_df['prediction'] + (1.96 * meta_df['std_error'])
@@ -231,14 +241,9 @@ def load(meta_df):
 
     logger.info('Begin data load')
 
-    # Create connection engine
-    engine = create_engine('postgresql://{}:{}@{}/{}'.format(cfg['db_user_name'],
-                                                             cfg['db_password'],
-                                                             cfg['db_IP'],
-                                                             cfg['db_name']))
-
-    # Load to database
-    meta_df.to_sql('model_meta', con=engine, if_exists='append', index=False)
+    # COPY straight into model_meta through a pooled connection
+    with db_pool.connection() as conn:
+        db.copy_df(conn, meta_df, 'model_meta')
 
     logger.info('Loading {} records to meta_df'.format(len(meta_df)))
     logger.info('Data load completed successfully')
@@ -1,17 +1,21 @@
+import sys
+sys.path.append('..')
+
 import lib
-import yaml
 import logging
 import warnings
 import pandas as pd
 import datetime as dt
-from sqlalchemy import create_engine
+
+import db
+import db_pool
+from cfg import load_cfg, save_cfg
 
 # Ignore warnings
 warnings.filterwarnings("ignore")
 
 # Load config file
-with open("../../config.yml", 'r') as infile:
-    cfg = yaml.load(infile)
+cfg = load_cfg()
 
 # Store date information
 today = dt.datetime.today()
@@ -22,16 +26,19 @@ forecast_start = forecast_start.date()
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# Create a file handler
-handler = logging.FileHandler('../../logs/models/holt_{}.log'.format(forecast_start))
-handler.setLevel(logging.INFO)
 
-# Create a logging format
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
+def _setup_logging():
+    """
+    Attach this run's log file to the logger, done at run time
+    so importing the module does not open a file
+    :return:
+    """
 
-# Add the handlers to the logger
-logger.addHandler(handler)
+    handler = logging.FileHandler('../../logs/models/holt_{}.log'.format(forecast_start))
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
 
 
 def main():
@@ -40,6 +47,8 @@ def main():
     :return:
     """
 
+    _setup_logging()
+
     logger.info('start_date for this forecast: {}'.format(forecast_start))
 
     # Run modelling script
@@ -50,8 +59,7 @@ def main():
 
     # Update config file with last_update
     cfg['last_holt_model_run'] = forecast_start
-    with open('../../config.yml', 'w') as outfile:
-        yaml.dump(cfg, outfile, default_flow_style=False)
+    save_cfg(cfg)
 
 
 def extract():
@@ -62,10 +70,6 @@ def extract():
 
     logger.info('Begin Extract')
 
-    engine = create_engine('postgresql://{}:{}@{}/{}'.format(cfg['db_user_name'],
-                                                             cfg['db_password'],
-                                                             cfg['db_IP'],
-                                                             cfg['db_name']))
     query = """
 
     with square_weekly as (
@@ -133,7 +137,8 @@ def extract():
     order by u2.profile_name, u2.week_date
 
     """.format(str(forecast_start), str(forecast_start))
-    data = pd.read_sql_query(query, con=engine)
+    # COPY the result set out as CSV rather than row tuples
+    data = db.read_query(query, parse_dates=['week_date'])
 
     logger.info('Data Extraction completed successfully')
 
@@ -152,8 +157,8 @@ def transform(data):
     data = data[data['week_date'] < forecast_start]
 
     # Exclude profile/forms with low counts
-    data['week_count'] = data['week_date'].groupby(data['profile_name']).transform('count')
-    data = data[data['week_count'] > 10]
+    counts = data['profile_name'].value_counts()
+    data = data[data['profile_name'].isin(counts[counts > 10].index)]
 
     # Aggregate data
     model_data = data.groupby(['week_date', 'profile_name']).sum().reset_index()
@@ -172,32 +177,31 @@ def model(model_data):
 
     logger.info('Begin modelling')
 
-    # Create framework for final dataframe
-    meta_df = pd.DataFrame(columns=[
-        'profile_name',
-        'mse',
-        'prediction',
-    ])
+    # Collect one row per profile and build the final frame once
+    rows = []
 
-    # For each profile/form combo fit model
-    for zolo_id in model_data['profile_name'].sort_values().unique():
-        # Get data for profile/form
-        temp_data = model_data[model_data['profile_name'] == zolo_id]
+    # For each profile/form combo fit model, partitioning the frame once
+    for zolo_id, temp_data in model_data.groupby('profile_name', sort=True):
 
         # Grid search model params
         mse, best_model = lib.evaluate_holt_model(temp_data['weight'].values)
 
         # Store meta information about models
         forecast = best_model.forecast()
-        temp_df = pd.DataFrame({
-            'profile_name': [zolo_id],
-            'mse': [mse],
+        rows.append({
+            'profile_name': zolo_id,
+            'mse': mse,
             'prediction': forecast[0],
         })
-        meta_df = pd.concat((meta_df, temp_df))
 
         logger.info('name_form: {} model complete'.format(zolo_id))
 
+    meta_df = pd.DataFrame(rows, columns=[
+        'profile_name',
+        'mse',
+        'prediction',
+    ])
+
     # Add datetime field
     meta_df['forecast_start'] = forecast_start
 
@@ -213,14 +217,10 @@ def load(meta_df):
 
     logger.info('Begin data load')
 
-    # Create connection engine
-    engine = create_engine('postgresql://{}:{}@{}/{}'.format(cfg['db_user_name'],
-                                                             cfg['db_password'],
-                                                             cfg['db_IP'],
-                                                             cfg['db_name']))
-
-    # Load to database
-    meta_df.to_sql('model_holt', con=engine, if_exists='append', index=False)
+    # COPY straight into model_holt through a pooled connection; the
+    # pinned pandas predates the to_sql method hook
+    with db_pool.connection() as conn:
+        db.copy_df(conn, meta_df, 'model_holt')
 
     logger.info('Loading {} records to model_holt'.format(len(meta_df)))
     logger.info('Data load completed successfully')
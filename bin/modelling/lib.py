@@ -1,34 +1,34 @@
+import os
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from joblib import Memory
+from threadpoolctl import threadpool_limits
+
 from statsmodels.tsa.arima_model import ARIMA
 from statsmodels.tsa.api import Holt
 from statsmodels.tsa.api import SimpleExpSmoothing
 from sklearn.metrics import mean_squared_error
 
 
-def evaluate_arima_model(X, arima_order):
+def evaluate_arima_model(X, arima_order, method='css'):
     """
-    Evaluate an ARIMA model for a given order (p,d,q)
+    Evaluate an ARIMA model for a given order (p,d,q), fit once on the
+    training split and scored on a forecast of the whole hold out
     :param X: list or series containing all historical data
     :param arima_order: Tuple with 3 integers representing the order for the model
+    :param method: fitting method, cheap CSS by default for the grid search
     :return: mse (error metric) and the fitted model
     """
     # Prepare training dataset
     train_size = int(len(X) * 0.75)
     train, test = X[0:train_size], X[train_size:]
-    history = [x for x in train]
-
-    # Make predictions
-    predictions = list()
-    for t in range(len(test)):
-        # Fit model
-        model = ARIMA(history, order=arima_order)
-        model_fit = model.fit(disp=0)
 
-        # Forecast
-        yhat = model_fit.forecast()[0]
-
-        # Store prediction and move forward one time step
-        predictions.append(yhat)
-        history.append(test[t])
+    # Fit once and forecast the full hold out
+    model = ARIMA(train, order=arima_order)
+    model_fit = model.fit(disp=0, method=method, maxiter=50)
+    predictions = model_fit.forecast(steps=len(test))[0]
 
     # calculate out of sample error
     mse = mean_squared_error(test, predictions)
@@ -44,13 +44,17 @@ def evaluate_holt_model(X):
     # Prepare training dataset
     train_size = int(len(X) * 0.75)
     train, test = X[0:train_size], X[train_size:]
-    history = [x for x in train]
+
+    # Preallocate the history buffer so each fit sees a contiguous view
+    history = np.empty(len(X), dtype=np.float64)
+    history[:train_size] = train
+    end = train_size
 
     # Make predictions
     predictions = list()
     for t in range(len(test)):
         # Fit model
-        model = Holt(history)
+        model = Holt(history[:end])
         model_fit = model.fit()
 
         # Forecast
@@ -58,7 +62,8 @@ def evaluate_holt_model(X):
 
         # Store prediction and move forward one time step
         predictions.append(yhat)
-        history.append(test[t])
+        history[end] = test[t]
+        end += 1
 
     # calculate out of sample error
     mse = mean_squared_error(test, predictions)
@@ -74,13 +79,17 @@ def evaluate_simp_avg_model(X):
     # Prepare training dataset
     train_size = int(len(X) * 0.75)
     train, test = X[0:train_size], X[train_size:]
-    history = [x for x in train]
+
+    # Preallocate the history buffer so each fit sees a contiguous view
+    history = np.empty(len(X), dtype=np.float64)
+    history[:train_size] = train
+    end = train_size
 
     # Make predictions
     predictions = list()
     for t in range(len(test)):
         # Fit model
-        model = SimpleExpSmoothing(history)
+        model = SimpleExpSmoothing(history[:end])
         model_fit = model.fit(smoothing_level=0.6, optimized=False)
 
         # Forecast
@@ -88,45 +97,99 @@ def evaluate_simp_avg_model(X):
 
         # Store prediction and move forward one time step
         predictions.append(yhat)
-        history.append(test[t])
+        history[end] = test[t]
+        end += 1
 
     # calculate out of sample error
     mse = mean_squared_error(test, predictions)
     return mse, model_fit
 
 
-def evaluate_models(X, p_values, d_values, q_values):
+def score_order(order, X):
+    """
+    Score a single model order, used as the worker for the parallel grid search
+    :param order: Tuple with 3 integers representing the order for the model
+    :param X: All historical data for product
+    :return: the order, its mse (inf for bad orders) and the fitted model
+    """
+
+    # Handle exceptions for bad model orders; the series are small enough
+    # that BLAS thread dispatch costs more than it saves, so pin each
+    # worker to a single BLAS thread
+    try:
+        with threadpool_limits(limits=1, user_api='blas'):
+            mse, model = evaluate_arima_model(X, order)
+        return order, mse, model
+    except:
+        return order, float("inf"), None
+
+
+# Cache grid-search winners on disk, keyed on the series and search space
+memory = Memory('../../cache/arima', verbose=0)
+
+
+@memory.cache
+def search_best_order(X, p_values, d_values, q_values):
     """
-    Evaluate all combinations of p, d and q values for an ARIMA model
+    Parallel grid search over all (p,d,q) combinations; only the winning
+    order and score are cached since fitted statsmodels objects do not
+    pickle stably across versions
     :param X: All historical data for product
     :param p_values: list with all values of p to test
     :param d_values: list with all values of d to test
     :param q_values: list with all values of q to test
-    :return: best_cfg (model order with lowest mse), best_score (mse), best_model (fitted model)
+    :return: best_cfg (model order with lowest mse) and best_score (mse)
     """
 
     # Initialize helper variables
-    X = X.astype('float32')
-    best_score, best_cfg, best_model = float("inf"), None, None
+    best_score, best_cfg = float("inf"), None
+
+    # Try cheap, stable orders first so a tight incumbent is set early
+    orders = sorted(itertools.product(p_values, d_values, q_values),
+                    key=lambda order: (order[1], order[0] + order[2]))
+
+    # Score the combos in waves of one-per-core and stop once a whole
+    # wave of costlier orders fails to beat the incumbent
+    workers = os.cpu_count()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for i in range(0, len(orders), workers):
+            improved = False
+
+            for order, mse, model in executor.map(score_order, orders[i:i + workers], itertools.repeat(X)):
+                if mse < best_score:
+                    best_score, best_cfg = mse, order
+                    improved = True
+
+            if best_cfg is not None and not improved:
+                break
 
-    # Loop through all combos
-    for p in p_values:
-        for d in d_values:
-            for q in q_values:
+    return best_cfg, best_score
 
-                # Set the order
-                order = (p, d, q)
 
-                # Handle exceptions for bad model orders
-                try:
+def evaluate_models(X, p_values, d_values, q_values):
+    """
+    Evaluate all combinations of p, d and q values for an ARIMA model,
+    re-using a cached search result when the series has not changed
+    :param X: All historical data for product
+    :param p_values: list with all values of p to test
+    :param d_values: list with all values of d to test
+    :param q_values: list with all values of q to test
+    :return: best_cfg (model order with lowest mse), best_score (mse), best_model (fitted model)
+    """
+
+    # statsmodels promotes to float64 for LAPACK anyway,
+    # so hand it a contiguous float64 array up front
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    best_model = None
 
-                    # Score model on hold out data
-                    mse, model = evaluate_arima_model(X, order)
+    best_cfg, best_score = search_best_order(X, p_values, d_values, q_values)
 
-                    # Update best model if error is lower
-                    if mse < best_score:
-                        best_score, best_cfg, best_model = mse, order, model
-                except:
-                    continue
+    # Refit the winner with full MLE so the forecast intervals are sound
+    if best_cfg is not None:
+        try:
+            best_model = ARIMA(X, order=best_cfg).fit(disp=0, method='css-mle')
+        except:
+            best_model = ARIMA(X, order=best_cfg).fit(disp=0, method='css', maxiter=50)
 
     return best_cfg, best_score, best_model